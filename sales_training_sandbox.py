@@ -1,94 +1,159 @@
 import streamlit as st
-import json
+import logging
+import operator
+import orjson
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from openai import OpenAI
 from datetime import datetime
 
 # ---------------- CONFIG ----------------
 PROSPECTS_FILE = "data/prospects.json"
 DB_FILE = str(Path(__file__).parent / "leaderboard.db")
 MODEL_NAME = "gpt-4o"
+EVAL_MODEL = "gpt-4o-mini"  # fixed-format grading and coaching don't need the full model
 MAX_SCORE = 100
-
-# Load OpenAI API key from Streamlit Secrets
-OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
-client = OpenAI(api_key=OPENAI_API_KEY)
+CHATS_PER_PAGE = 50
+SUMMARY_MODEL = "gpt-4o-mini"
+HISTORY_WINDOW = 8  # most recent messages always sent verbatim
+BATCH_QUEUE_FILE = Path(__file__).parent / "batch_queue.jsonl"
+BATCH_POLL_SECONDS = 60
+BATCH_DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+logger = logging.getLogger(__name__)
+if not logger.handlers:
+    # The script re-runs on every interaction; only attach the handler once.
+    # Nothing else configures logging, so INFO lines (e.g. cached-token counts)
+    # would otherwise be dropped.
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# ---------------- OPENAI CLIENT ----------------
+@st.cache_resource
+def get_openai_client():
+    # One client per process so its HTTP connection pool is reused across reruns.
+    # The SDK is imported here so pages that never call the API skip loading it.
+    from openai import OpenAI
+    return OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
 
 # ---------------- DB FUNCTIONS ----------------
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("CREATE TABLE IF NOT EXISTS leaderboard (name TEXT, score INTEGER, timestamp TEXT)")
-    c.execute("CREATE TABLE IF NOT EXISTS chat_history (name TEXT, chat TEXT, timestamp TEXT)")
-    c.execute("CREATE TABLE IF NOT EXISTS performance_reports (name TEXT, avg_score REAL, summary TEXT, timestamp TEXT)")
-    conn.commit()
-    conn.close()
-
-def add_score_to_db(name, score):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
+@st.cache_resource
+def get_conn():
+    # One long-lived connection per process instead of an open/close per helper
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA cache_size=-20000;"
+        "PRAGMA busy_timeout=5000;"
+    )
+    # Schema setup runs once per process here rather than on every rerun
+    init_db(conn)
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    # Streamlit sessions run in separate threads but share the connection above
+    return threading.Lock()
+
+@contextmanager
+def db_write():
+    conn = get_conn()
+    with get_write_lock(), conn:
+        conn.execute("BEGIN IMMEDIATE")
+        yield conn
+
+def init_db(c):
+    with c:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("CREATE TABLE IF NOT EXISTS leaderboard (name TEXT, score INTEGER, timestamp TEXT)")
+        c.execute("CREATE TABLE IF NOT EXISTS chat_history (name TEXT, chat TEXT, timestamp TEXT)")
+        c.execute("CREATE TABLE IF NOT EXISTS performance_reports (name TEXT, avg_score REAL, summary TEXT, timestamp TEXT)")
+        c.execute("CREATE TABLE IF NOT EXISTS batch_jobs (batch_id TEXT, status TEXT, timestamp TEXT)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_lb_name ON leaderboard (name)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_lb_score ON leaderboard (score DESC, timestamp ASC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chat_name_ts ON chat_history (name, timestamp DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chat_ts ON chat_history (timestamp DESC)")
+
+def now_ts():
+    # Naive local time, the format existing rows use; timestamps are compared as
+    # strings in ORDER BY, so mixing in UTC offsets would mis-sort old and new rows
+    return datetime.now().isoformat()
+
+def new_pending_writes():
+    return {"leaderboard": [], "chat_history": []}
+
+def buffer_score(pending, name, score, ts=None):
+    pending["leaderboard"].append((name, score, ts or now_ts()))
+
+def buffer_chat(pending, name, chat_text, ts=None):
+    pending["chat_history"].append((name, chat_text, ts or now_ts()))
+
+def write_buffered(c, pending):
+    # Run inside db_write() so every row of one event lands in one transaction
+    c.executemany(
         "INSERT INTO leaderboard (name, score, timestamp) VALUES (?, ?, ?)",
-        (name, score, datetime.now().isoformat())
+        pending["leaderboard"]
     )
-    conn.commit()
-    conn.close()
-
-def add_chat_to_db(name, chat_text):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
+    c.executemany(
         "INSERT INTO chat_history (name, chat, timestamp) VALUES (?, ?, ?)",
-        (name, chat_text, datetime.now().isoformat())
+        pending["chat_history"]
     )
-    conn.commit()
-    conn.close()
-
-def store_performance_summary(name, avg_score, summary):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO performance_reports (name, avg_score, summary, timestamp) VALUES (?, ?, ?, ?)",
-        (name, avg_score, summary, datetime.now().isoformat())
-    )
-    conn.commit()
-    conn.close()
+
+def store_performance_summary(name, avg_score, summary, ts=None):
+    with db_write() as c:
+        c.execute(
+            "INSERT INTO performance_reports (name, avg_score, summary, timestamp) VALUES (?, ?, ?, ?)",
+            (name, avg_score, summary, ts or now_ts())
+        )
 
 def get_top_scores(limit=10):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
+    c = get_conn()
+    return c.execute(
         "SELECT name, score FROM leaderboard ORDER BY score DESC, timestamp ASC LIMIT ?",
         (limit,)
-    )
-    results = c.fetchall()
-    conn.close()
-    return results
-
-def get_all_chats():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "SELECT name, chat, timestamp FROM chat_history ORDER BY timestamp DESC"
-    )
-    results = c.fetchall()
-    conn.close()
-    return results
+    ).fetchall()
+
+@st.cache_data(ttl=5)
+def get_leaderboard(limit=10):
+    return get_top_scores(limit)
+
+def get_all_chats(limit=50, offset=0):
+    c = get_conn()
+    return c.execute(
+        "SELECT rowid, name, timestamp FROM chat_history ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+        (limit, offset)
+    ).fetchall()
+
+def get_chat(rowid):
+    c = get_conn()
+    row = c.execute("SELECT chat FROM chat_history WHERE rowid = ?", (rowid,)).fetchone()
+    return row[0] if row else ""
+
+@st.cache_data(ttl=30)
+def get_chat_page(page):
+    return get_all_chats(limit=CHATS_PER_PAGE, offset=(page - 1) * CHATS_PER_PAGE)
+
+def get_recent_chats(name, limit=5):
+    c = get_conn()
+    return c.execute(
+        "SELECT chat, timestamp FROM chat_history WHERE name = ? ORDER BY timestamp DESC LIMIT ?",
+        (name, limit)
+    ).fetchall()
 
 def get_user_feedback_summary(name):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT score FROM leaderboard WHERE name = ?", (name,))
-    scores = [row[0] for row in c.fetchall()]
-    avg_score = round(sum(scores) / len(scores), 1) if scores else 0
-
-    c.execute(
-        "SELECT chat FROM chat_history WHERE name = ? ORDER BY timestamp DESC LIMIT 5",
-        (name,)
-    )
-    recent = c.fetchall()
-    transcript_blocks = "\n\n".join(chat[0] for chat in recent)
+    c = get_conn().cursor()
+    c.execute("SELECT ROUND(AVG(score), 1) FROM leaderboard WHERE name = ?", (name,))
+    avg_score = c.fetchone()[0] or 0
+
+    recent = get_recent_chats(name)
+    transcript_blocks = "\n\n".join(chat for chat, _ in recent)
 
     prompt = f"""
 You are a sales performance coach. Analyze this user's last 5 sales chats and summarize:
@@ -100,24 +165,284 @@ Chat transcripts:
 {transcript_blocks}
     """
 
-    resp = client.chat.completions.create(
-        model=MODEL_NAME,
+    resp = get_openai_client().chat.completions.create(
+        model=EVAL_MODEL,
         messages=[{"role": "system", "content": prompt}]
     )
     return avg_score, resp.choices[0].message.content.strip()
 
-# ---------------- APP LAYOUT ----------------
-init_db()
+# ---------------- CONVERSATION MEMORY ----------------
+def summarize_history(previous_summary, transcript_lines):
+    dialogue = "\n".join(transcript_lines)
+    prompt = f"""
+Summarize this sales conversation between a trainee and a prospect in under 300 tokens.
+Keep what the trainee has learned, which pain points were revealed, and any objections raised.
+
+Earlier summary:
+{previous_summary or "(none)"}
+
+New messages:
+{dialogue}
+"""
+    resp = get_openai_client().chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[{"role": "system", "content": prompt}],
+        max_tokens=300
+    )
+    return resp.choices[0].message.content.strip()
+
+# ---------------- EVALUATION ----------------
+EVAL_EXAMPLES = """
+Chat:
+Trainee: Hi, I'm calling about our training platform. Want a demo?
+Prospect: Not really, we're busy.
+Trainee: It's really good, you should try it. I'll send a link.
+Score:
+{"rapport": 2, "discovery": 0, "solution_alignment": 1, "objection_handling": 1, "closing": 2, "positivity": 4, "dale_carnegie_principles": 0, "feedback": {"rapport": "No greeting by name or interest in the prospect.", "discovery": "Asked no questions about their business.", "solution_alignment": "Pitched before knowing any need.", "objection_handling": "Ignored 'we're busy'.", "closing": "Pushed a link without agreement.", "positivity": "Upbeat but generic.", "dale_carnegie_principles": "Talked only about the product."}}
+
+Chat:
+Trainee: Thanks for making time, Sam. How is the new sales team settling in?
+Prospect: Slowly. Ramp-up takes months.
+Trainee: What slows it down most?
+Prospect: Nobody has time to coach them.
+Trainee: Our AI role-play gives reps daily practice with feedback. Worth trying with two reps?
+Prospect: Maybe, send details.
+Score:
+{"rapport": 7, "discovery": 6, "solution_alignment": 7, "objection_handling": 5, "closing": 5, "positivity": 7, "dale_carnegie_principles": 3, "feedback": {"rapport": "Warm opener using their name.", "discovery": "Found the coaching gap but didn't quantify it.", "solution_alignment": "Solution maps to the stated pain.", "objection_handling": "No objection explored.", "closing": "Soft ask with no concrete next step.", "positivity": "Encouraging tone.", "dale_carnegie_principles": "Showed interest in their problem."}}
+
+Chat:
+Trainee: Jordan, I read your post about scaling the support team, congrats on the growth. What's the hardest part right now?
+Prospect: Churn after onboarding. Sales promises things ops can't deliver.
+Trainee: How many accounts did that cost you last quarter?
+Prospect: About ten.
+Trainee: Our scenario training aligns reps with what ops can deliver, and clients like yours cut early churn within a quarter. Could we pilot it with your team on Tuesday?
+Prospect: Price worries me.
+Trainee: Understandable. Ten saved accounts would cover it several times over. Shall I book Tuesday at 10?
+Prospect: Yes, let's do it.
+Score:
+{"rapport": 9, "discovery": 9, "solution_alignment": 9, "objection_handling": 8, "closing": 9, "positivity": 9, "dale_carnegie_principles": 5, "feedback": {"rapport": "Personal, specific opener.", "discovery": "Uncovered and quantified the pain.", "solution_alignment": "Tied the offer directly to churn.", "objection_handling": "Reframed price as ROI.", "closing": "Asked for a specific meeting.", "positivity": "Confident and respectful.", "dale_carnegie_principles": "Led with their interests throughout."}}
+"""
+
+# Everything but the transcript is fixed, so render it once at import time
+EVAL_PROMPT_PREFIX = """
+You are a sales coach. Return ONLY raw JSON.
+Evaluate this chat:
+{
+  "rapport": 0-10,
+  "discovery": 0-10,
+  "solution_alignment": 0-10,
+  "objection_handling": 0-10,
+  "closing": 0-10,
+  "positivity": 0-10,
+  "dale_carnegie_principles": 0-5,
+  "feedback": {
+    "rapport": "...",
+    "discovery": "...",
+    "solution_alignment": "...",
+    "objection_handling": "...",
+    "closing": "...",
+    "positivity": "...",
+    "dale_carnegie_principles": "..."
+  }
+}
+
+Scored examples:
+""" + EVAL_EXAMPLES + """
+
+Chat:
+"""
+
+def build_eval_prompt(transcript):
+    return EVAL_PROMPT_PREFIX + transcript + "\n"
 
+_score_keys = operator.itemgetter(
+    'rapport', 'discovery', 'solution_alignment', 'objection_handling', 'closing', 'positivity'
+)
+
+def score_evaluation(text):
+    # JSON mode guarantees a bare object, no markdown fences to strip
+    result = orjson.loads(text)
+
+    # compute total out of 100 (six categories scored 0-10)
+    # int() because JSON mode doesn't guarantee the model returns whole numbers
+    return result, int(sum(_score_keys(result)) * MAX_SCORE // 60)
+
+# ---------------- BATCH GRADING ----------------
+def queue_for_batch_grading(name, transcript, ts=None):
+    # Interactive scoring stays on the live endpoint; this queues a chat for the
+    # cheaper, asynchronous Batch API.
+    ts = ts or now_ts()
+    line = orjson.dumps({
+        "custom_id": f"{name}|{ts}",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": EVAL_MODEL,
+            "messages": [{"role": "system", "content": build_eval_prompt(transcript)}],
+            "response_format": {"type": "json_object"}
+        }
+    }).decode()
+    with get_write_lock():
+        with BATCH_QUEUE_FILE.open("a", encoding="utf-8") as fh:
+            fh.write(line + "\n")
+    count_queued_chats.clear()
+
+@st.cache_data(ttl=30)
+def count_queued_chats():
+    if not BATCH_QUEUE_FILE.exists():
+        return 0
+    with BATCH_QUEUE_FILE.open(encoding="utf-8") as fh:
+        return sum(1 for _ in fh)
+
+def submit_batch():
+    with get_write_lock():
+        if not BATCH_QUEUE_FILE.exists():
+            return None
+        data = BATCH_QUEUE_FILE.read_bytes()
+        BATCH_QUEUE_FILE.unlink()
+    count_queued_chats.clear()
+
+    client = get_openai_client()
+    try:
+        upload = client.files.create(file=(BATCH_QUEUE_FILE.name, data), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=upload.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+    except Exception:
+        # put the queued chats back so the next submit retries them
+        with get_write_lock():
+            with BATCH_QUEUE_FILE.open("ab") as fh:
+                fh.write(data)
+        count_queued_chats.clear()
+        raise
+
+    with db_write() as c:
+        c.execute(
+            "INSERT INTO batch_jobs (batch_id, status, timestamp) VALUES (?, ?, ?)",
+            (batch.id, batch.status, now_ts())
+        )
+    start_batch_poller(client)
+    return batch.id
+
+def get_pending_batch_ids():
+    rows = get_conn().execute(
+        "SELECT batch_id FROM batch_jobs WHERE status NOT IN (%s)"
+        % ", ".join("?" * len(BATCH_DONE_STATUSES)),
+        BATCH_DONE_STATUSES
+    ).fetchall()
+    return [batch_id for (batch_id,) in rows]
+
+def poll_batches(client):
+    for batch_id in get_pending_batch_ids():
+        batch = client.batches.retrieve(batch_id)
+        pending = new_pending_writes()
+        done = batch.status in BATCH_DONE_STATUSES
+        # Expired and cancelled batches still publish the requests that finished
+        if done and batch.output_file_id:
+            for line in client.files.content(batch.output_file_id).text.splitlines():
+                # A bad line must not block the rest of the batch from being recorded
+                try:
+                    item = orjson.loads(line)
+                    if item.get("error") or item["response"]["status_code"] != 200:
+                        logger.warning(
+                            "Batch %s could not grade %s: %r",
+                            batch_id, item.get("custom_id"), item.get("error") or item["response"]["body"]
+                        )
+                        continue
+                    # custom_id carries the chat's own timestamp; reuse it for the score
+                    name, ts = item["custom_id"].rsplit("|", 1)
+                    text = item["response"]["body"]["choices"][0]["message"]["content"]
+                    _, score = score_evaluation(text)
+                except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+                    logger.warning("Skipping unreadable line in batch %s: %r", batch_id, line[:200])
+                    continue
+                buffer_score(pending, name, score, ts)
+        with db_write() as c:
+            write_buffered(c, pending)
+            c.execute("UPDATE batch_jobs SET status = ? WHERE batch_id = ?", (batch.status, batch_id))
+        if done:
+            get_leaderboard.clear()
+
+@st.cache_resource
+def start_batch_poller(_client):
+    def run():
+        while True:
+            try:
+                poll_batches(_client)
+            except Exception:
+                logger.exception("Batch grading poll failed")
+            time.sleep(BATCH_POLL_SECONDS)
+
+    thread = threading.Thread(target=run, name="batch-grading-poller", daemon=True)
+    thread.start()
+    return thread
+
+@st.cache_resource
+def resume_batch_poller():
+    # Checked once per process; submit_batch() starts the poller for new batches
+    if get_pending_batch_ids():
+        return start_batch_poller(get_openai_client())
+    return None
+
+# ---------------- PROSPECT PERSONA ----------------
+# The persona is the first message and depends only on the prospect, so it is
+# byte-identical every turn; chat turns and the rolling summary follow it.
+def build_persona_prompt(p):
+    return (
+        f"You are '{p['name']}', a {p['role']} at {p['company']} ({p['industry']}). "
+        f"Your hidden pain points: {p.get('pain_points','')}. "
+        "Reveal them only if the trainee asks good discovery questions. "
+        "If they uncover your pain and propose your solution, respond that you're ready and excited."
+    )
+
+def stream_reply(stream):
+    for chunk in stream:
+        if chunk.usage:
+            details = chunk.usage.prompt_tokens_details
+            logger.info(
+                "Prospect reply used %s prompt tokens (%s cached)",
+                chunk.usage.prompt_tokens,
+                details.cached_tokens if details else 0
+            )
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+# ---------------- PROSPECT DATA ----------------
+@st.cache_data
+def load_prospects(path):
+    data = orjson.loads(Path(path).read_bytes())
+    # Build labels: Company — Name (Role) — Industry
+    return {
+        f"{p['company']} — {p['name']} ({p['role']}) — {p['industry']}": p
+        for p in data
+    }
+
+@st.cache_data
+def get_persona_prompt(prospect_label):
+    # Labels are unique per prospect; caching keeps the system prompt byte-identical every turn
+    return build_persona_prompt(load_prospects(PROSPECTS_FILE)[prospect_label])
+
+# ---------------- APP LAYOUT ----------------
 # Initialize session state
 if "history" not in st.session_state:
     st.session_state.history = []
+if "transcript_parts" not in st.session_state:
+    # "Trainee: ..." / "Prospect: ..." lines kept in step with history
+    st.session_state.transcript_parts = []
+if "history_summary" not in st.session_state:
+    st.session_state.history_summary = ""
+    st.session_state.summarized_upto = 0
 if "selected_prospect" not in st.session_state:
     st.session_state.selected_prospect = None
 if "trainee_name" not in st.session_state:
     st.session_state.trainee_name = ""
 
 st.set_page_config(page_title="Sales Training Chatbot", layout="wide")
+# After set_page_config: a cache miss here renders a spinner, which older
+# Streamlit versions reject before the page config is set
+resume_batch_poller()
 st.markdown("## Sales Training Chatbot")
 
 # Sidebar: Trainee Info
@@ -126,15 +451,9 @@ with st.sidebar:
     st.session_state.trainee_name = st.text_input("Enter your name")
 
 # ---------------- Prospect Selection ----------------
-prospects = json.loads(Path(PROSPECTS_FILE).read_text())
-# Build labels: Company — Name (Role) — Industry
-labels = [
-    f"{p['company']} — {p['name']} ({p['role']}) — {p['industry']}"
-    for p in prospects
-]
-selected_label = st.selectbox("Select Prospect", labels)
-idx = labels.index(selected_label)
-st.session_state.selected_prospect = prospects[idx]
+prospects_by_label = load_prospects(PROSPECTS_FILE)
+selected_label = st.selectbox("Select Prospect", list(prospects_by_label))
+st.session_state.selected_prospect = prospects_by_label[selected_label]
 
 # Show Persona Card (with labels)
 p = st.session_state.selected_prospect
@@ -159,23 +478,41 @@ for speaker, text in st.session_state.history:
 user_input = st.chat_input("💬 Your message")
 if user_input:
     st.session_state.history.append(("sales_rep", user_input))
+    st.session_state.transcript_parts.append(f"Trainee: {user_input}")
 
     # Build LLM prompt for prospect simulation
-    prompt = (
-        f"You are '{p['name']}', a {p['role']} at {p['company']} ({p['industry']}). "
-        f"Your hidden pain points: {p.get('pain_points','')}. "
-        "Reveal them only if the trainee asks good discovery questions. "
-        "If they uncover your pain and propose your solution, respond that you're ready and excited."
-    )
+    prompt = get_persona_prompt(selected_label)
+    # Fold older messages into a rolling summary so the prompt stays bounded;
+    # folding in chunks keeps the summary call off most turns.
+    history = st.session_state.history
+    if len(history) - st.session_state.summarized_upto > 2 * HISTORY_WINDOW:
+        cut = len(history) - HISTORY_WINDOW
+        st.session_state.history_summary = summarize_history(
+            st.session_state.history_summary,
+            st.session_state.transcript_parts[st.session_state.summarized_upto:cut]
+        )
+        st.session_state.summarized_upto = cut
+
     messages = [{"role": "system", "content": prompt}]
-    for spk, txt in st.session_state.history:
+    if st.session_state.history_summary:
+        messages.append({
+            "role": "system",
+            "content": f"Summary of the conversation so far: {st.session_state.history_summary}"
+        })
+    for spk, txt in history[st.session_state.summarized_upto:]:
         role = "assistant" if spk == "prospect" else "user"
         messages.append({"role": role, "content": txt})
 
-    resp = client.chat.completions.create(model=MODEL_NAME, messages=messages)
-    reply = resp.choices[0].message.content.strip()
+    stream = get_openai_client().chat.completions.create(
+        model=MODEL_NAME,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    reply = st.chat_message("Prospect", avatar="🌱").write_stream(stream_reply(stream))
+    reply = reply.strip()
     st.session_state.history.append(("prospect", reply))
-    st.chat_message("Prospect", avatar="🌱").write(reply)
+    st.session_state.transcript_parts.append(f"Prospect: {reply}")
 
 # ---------------- Sidebar: Scoring & History ----------------
 with st.sidebar:
@@ -186,78 +523,69 @@ with st.sidebar:
         if not name:
             st.warning("Please enter your name first.")
         else:
-            transcript = "\n".join(
-                f"{'Trainee' if s=='sales_rep' else 'Prospect'}: {t}"
-                for s, t in st.session_state.history
-            )
-            eval_prompt = f"""
-You are a sales coach. Return ONLY raw JSON.
-Evaluate this chat:
-{{
-  "rapport": 0-10,
-  "discovery": 0-10,
-  "solution_alignment": 0-10,
-  "objection_handling": 0-10,
-  "closing": 0-10,
-  "positivity": 0-10,
-  "dale_carnegie_principles": 0-5,
-  "feedback": {{
-    "rapport": "...",
-    "discovery": "...",
-    "solution_alignment": "...",
-    "objection_handling": "...",
-    "closing": "...",
-    "positivity": "...",
-    "dale_carnegie_principles": "..."
-  }}
-}}
-Chat:
-{transcript}
-"""
-            resp = client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[{"role": "system", "content": eval_prompt}]
+            transcript = "\n".join(st.session_state.transcript_parts)
+            resp = get_openai_client().chat.completions.create(
+                model=EVAL_MODEL,
+                messages=[{"role": "system", "content": build_eval_prompt(transcript)}],
+                response_format={"type": "json_object"}
             )
-            text = resp.choices[0].message.content.strip()
-            # strip markdown/fences
-            if text.startswith("```"):
-                text = text.strip("`").split("json",1)[-1].strip()
-            result = json.loads(text)
-
-            # compute total out of 100
-            total = sum([
-                result['rapport'],
-                result['discovery'],
-                result['solution_alignment'],
-                result['objection_handling'],
-                result['closing'],
-                result['positivity']
-            ]) * (100 / 60)
-            score = int(total)
-
-            add_score_to_db(name, score)
-            add_chat_to_db(name, transcript)
+            result, score = score_evaluation(resp.choices[0].message.content)
+
+            ts = now_ts()
+            pending = new_pending_writes()
+            buffer_score(pending, name, score, ts)
+            buffer_chat(pending, name, transcript, ts)
+            with db_write() as c:
+                write_buffered(c, pending)
+            get_leaderboard.clear()
+            get_chat_page.clear()
 
             st.success(f"🏆 Score: {score}/100")
             st.write("### Feedback")
             for k, v in result['feedback'].items():
                 st.write(f"**{k.capitalize()}**: {v}")
 
+    if st.button("Queue for Batch Grading"):
+        name = st.session_state.trainee_name.strip()
+        if not name:
+            st.warning("Please enter your name first.")
+        elif not st.session_state.transcript_parts:
+            st.warning("Chat with the prospect before queueing for grading.")
+        else:
+            transcript = "\n".join(st.session_state.transcript_parts)
+            ts = now_ts()
+            queue_for_batch_grading(name, transcript, ts)
+            pending = new_pending_writes()
+            buffer_chat(pending, name, transcript, ts)
+            with db_write() as c:
+                write_buffered(c, pending)
+            get_chat_page.clear()
+            st.info("📥 Chat queued; its score will appear on the leaderboard once the batch completes.")
+
+    queued = count_queued_chats()
+    if queued and st.button(f"Submit for Batch Grading ({queued} queued)"):
+        batch_id = submit_batch()
+        if batch_id:
+            st.success(f"📨 Batch {batch_id} submitted.")
+
     if st.button("Start New Prospect"):
         st.session_state.history = []
+        st.session_state.transcript_parts = []
+        st.session_state.history_summary = ""
+        st.session_state.summarized_upto = 0
 
     st.write("### 🏅 Leaderboard")
-    for nm, sc in get_top_scores():
+    for nm, sc in get_leaderboard():
         st.write(f"{nm}: {sc}")
 
     st.write("### 📜 Past Chats")
-    all_chats = get_all_chats()
-    chat_labels = [f"{n} — {ts}" for n, _, ts in all_chats]
-    sel = st.selectbox("Choose a chat", chat_labels)
-    for nm, ch, ts in all_chats:
-        if f"{nm} — {ts}" == sel:
-            with st.expander(f"Transcript from {ts}", expanded=True):
-                st.code(ch)
+    page = st.number_input("Page", min_value=1, value=1, step=1)
+    by_label = {f"{n} — {ts}": (rowid, ts) for rowid, n, ts in get_chat_page(int(page))}
+    sel = st.selectbox("Choose a chat", list(by_label))
+    if sel:
+        rowid, ts = by_label[sel]
+        with st.expander(f"Transcript from {ts}", expanded=True):
+            st.code(get_chat(rowid))
 
     st.write("### 📈 Performance Summary")
     if st.button("Generate Summary"):